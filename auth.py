@@ -1,15 +1,9 @@
 from fastapi import Header, HTTPException, status
-import psycopg2
-import os
+
+from services.db import get_connection, release_connection
 
 def get_api_key(x_api_key: str = Header(...)):
-    conn = psycopg2.connect(
-        dbname=os.getenv("POSTGRES_DB"),
-        user=os.getenv("POSTGRES_USER"),
-        password=os.getenv("POSTGRES_PASSWORD"),
-        host="localhost",
-        port=os.getenv("POSTGRES_PORT"),
-    )
+    conn = get_connection()
 
     try:
         with conn.cursor() as cur:
@@ -43,4 +37,4 @@ def get_api_key(x_api_key: str = Header(...)):
         }
 
     finally:
-        conn.close()
+        release_connection(conn)
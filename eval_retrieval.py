@@ -0,0 +1,304 @@
+import argparse
+import json
+import time
+from pathlib import Path
+import numpy as np
+from pgvector import Vector
+
+from services.db import get_connection, release_connection
+from services.retrieval_service import (
+    EMBEDDING_MODEL,
+    STRICT_THRESHOLD,
+    FALLBACK_THRESHOLD,
+    ann_candidates,
+    search_by_vector,
+)
+
+# --------------------------------------------------
+# CONFIGURACIÓN
+# --------------------------------------------------
+TOP_K = 5
+QUERIES_PATH = Path("data/eval/queries.json")
+
+# Matriz por defecto; se puede sustituir con --configs <fichero.json>
+DEFAULT_CONFIGS = [
+    {"name": "baseline"},
+    {"name": "rerank=length", "rerank": "length"},
+    {"name": "ef_search=100", "session_settings": {"hnsw.ef_search": 100}},
+    {"name": "ef_search=200", "session_settings": {"hnsw.ef_search": 200}},
+    {"name": "probes=10", "session_settings": {"ivfflat.probes": 10}},
+    {"name": "threshold=0.30/0.20", "strict_threshold": 0.30, "fallback_threshold": 0.20},
+    {"name": "candidates=50", "candidate_limit": 50},
+]
+
+# --------------------------------------------------
+# QUERY SET
+# --------------------------------------------------
+def synthetic_queries(model: str, n: int, noise: float, seed: int = 0) -> list:
+    """Consultas sintéticas: vectores de chunks reales con ruido gaussiano.
+
+    No necesita la API de OpenAI. `noise` es la norma relativa del ruido.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT setseed(%s);", (seed / 1000.0,))
+            cur.execute(
+                """
+                SELECT e.embedding, d.domain, d.module, d.language
+                FROM embeddings e
+                JOIN chunks c ON c.id = e.chunk_id
+                JOIN documents d ON d.id = c.document_id
+                WHERE e.model = %s
+                ORDER BY random()
+                LIMIT %s;
+                """,
+                (model, n)
+            )
+            rows = cur.fetchall()
+    finally:
+        release_connection(conn)
+
+    rng = np.random.default_rng(seed)
+    queries = []
+    for emb, domain, module, language in rows:
+        v = np.asarray(emb, dtype=np.float32)
+        v = v / np.linalg.norm(v)
+        v = v + noise * rng.normal(size=v.shape).astype(np.float32) / np.sqrt(v.size)
+        queries.append({
+            "question": None,
+            "domain": domain,
+            "module": module,
+            "language": language,
+            "vector": (v / np.linalg.norm(v)).tolist(),
+        })
+    return queries
+
+def metrics_queries(model: str, n: int) -> list:
+    """Preguntas reales más frecuentes de query_metrics.
+
+    Es el único paso que llama a OpenAI (para embeberlas); el resultado se
+    guarda en disco y la evaluación posterior es totalmente offline.
+    """
+    from services.retrieval_service import embed_many
+
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT question, domain, module, language
+                FROM query_metrics
+                GROUP BY question, domain, module, language
+                ORDER BY count(*) DESC
+                LIMIT %s;
+                """,
+                (n,)
+            )
+            rows = cur.fetchall()
+    finally:
+        release_connection(conn)
+
+    vectors = embed_many([r[0] for r in rows], model=model)
+    return [
+        {
+            "question": q,
+            "domain": d,
+            "module": m,
+            "language": l,
+            "vector": v.to_list(),
+        }
+        for (q, d, m, l), v in zip(rows, vectors)
+    ]
+
+# --------------------------------------------------
+# GROUND TRUTH (top-k exacto por fuerza bruta)
+# --------------------------------------------------
+def exact_top_k(query_vector: Vector, model: str, q: dict, k: int) -> list:
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            # Sin índice: el planner hace scan secuencial y el orden es exacto
+            cur.execute("SELECT set_config('enable_indexscan', 'off', false);")
+            sql = """
+                SELECT c.id
+                FROM embeddings e
+                JOIN chunks c ON c.id = e.chunk_id
+                JOIN documents d ON d.id = c.document_id
+                WHERE e.model = %s AND d.domain = %s
+            """
+            params = [model, q["domain"]]
+            if q["module"]:
+                sql += " AND d.module = %s"
+                params.append(q["module"])
+            if q["language"]:
+                sql += " AND d.language = %s"
+                params.append(q["language"])
+            sql += " ORDER BY e.embedding <=> %s LIMIT %s;"
+            params.extend([query_vector, k])
+
+            cur.execute(sql, params)
+            return [str(r[0]) for r in cur.fetchall()]
+    finally:
+        if not conn.closed:
+            with conn.cursor() as cur:
+                cur.execute("RESET enable_indexscan;")
+        release_connection(conn)
+
+# --------------------------------------------------
+# EVALUACIÓN
+# --------------------------------------------------
+def run_config(config: dict, queries: list, truths: list, model: str, k: int) -> dict:
+    """Evalúa una configuración contra el top-k exacto.
+
+    recall@k mide el índice ANN aislado: sus k primeros candidatos, sin
+    umbral, dedupe ni rerank. overlap@k mide lo que llega al prompt tras
+    todo el pipeline (umbral, fallback, dedupe y rerank); el MMR descarta
+    vecinos casi duplicados a propósito, así que no debe tender a 1.
+    """
+    recalls = []
+    overlaps = []
+    ann_latencies = []
+    latencies = []
+    fallbacks = 0
+    empty = 0
+
+    for q, truth in zip(queries, truths):
+        vector = Vector(q["vector"])
+        session_settings = config.get("session_settings")
+
+        start = time.perf_counter()
+        candidates = ann_candidates(
+            vector, model, q["domain"], q["module"], q["language"],
+            limit=k,
+            session_settings=session_settings,
+        )
+        ann_latencies.append((time.perf_counter() - start) * 1000)
+
+        kwargs = dict(
+            rerank=config.get("rerank"),
+            candidate_limit=config.get("candidate_limit"),
+            session_settings=session_settings,
+        )
+
+        start = time.perf_counter()
+        results = search_by_vector(
+            vector, model, q["domain"], q["module"], q["language"],
+            top_k=k,
+            similarity_threshold=config.get("strict_threshold", STRICT_THRESHOLD),
+            **kwargs
+        )
+        if not results:
+            fallbacks += 1
+            results = search_by_vector(
+                vector, model, q["domain"], q["module"], q["language"],
+                top_k=k,
+                similarity_threshold=config.get("fallback_threshold", FALLBACK_THRESHOLD),
+                **kwargs
+            )
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        if not results:
+            empty += 1
+        if truth:
+            truth_ids = set(truth)
+            ann_ids = {r["chunk_id"] for r in candidates}
+            retrieved = {r["chunk_id"] for r in results}
+            recalls.append(len(ann_ids & truth_ids) / len(truth_ids))
+            overlaps.append(len(retrieved & truth_ids) / len(truth_ids))
+
+    ann_lat = np.asarray(ann_latencies)
+    lat = np.asarray(latencies)
+    n = len(queries)
+    return {
+        "name": config["name"],
+        "config": config,
+        "queries": n,
+        f"recall@{k}": float(np.mean(recalls)) if recalls else 0.0,
+        f"overlap@{k}": float(np.mean(overlaps)) if overlaps else 0.0,
+        "fallback_rate": fallbacks / n if n else 0.0,
+        "empty_rate": empty / n if n else 0.0,
+        "ann_p50_ms": float(np.percentile(ann_lat, 50)) if n else 0.0,
+        "ann_p99_ms": float(np.percentile(ann_lat, 99)) if n else 0.0,
+        "p50_ms": float(np.percentile(lat, 50)) if n else 0.0,
+        "p99_ms": float(np.percentile(lat, 99)) if n else 0.0,
+    }
+
+def evaluate(queries: list, configs: list, model: str, k: int) -> list:
+    print(f"📐 Ground truth exacto para {len(queries)} consultas (k={k})")
+    truths = [
+        exact_top_k(Vector(q["vector"]), model, q, k)
+        for q in queries
+    ]
+    reports = []
+    for config in configs:
+        report = run_config(config, queries, truths, model, k)
+        reports.append(report)
+        print(
+            f"• {config['name']}: recall@{k}={report[f'recall@{k}']:.3f} "
+            f"overlap@{k}={report[f'overlap@{k}']:.3f}"
+        )
+    return reports
+
+def print_table(reports: list, k: int):
+    header = (
+        f"{'config':<24} {'recall@' + str(k):>9} {'overlap@' + str(k):>10} "
+        f"{'fallback':>9} {'empty':>7} {'ann p50':>8} {'ann p99':>8} "
+        f"{'p50 ms':>8} {'p99 ms':>8}"
+    )
+    print("\n" + header)
+    print("-" * len(header))
+    for r in reports:
+        print(
+            f"{r['name']:<24} {r[f'recall@{k}']:>9.3f} {r[f'overlap@{k}']:>10.3f} "
+            f"{r['fallback_rate']:>9.1%} {r['empty_rate']:>7.1%} "
+            f"{r['ann_p50_ms']:>8.2f} {r['ann_p99_ms']:>8.2f} "
+            f"{r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f}"
+        )
+
+# --------------------------------------------------
+# CLI
+# --------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Evalúa recall y latencia de search bajo varias configuraciones"
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build = sub.add_parser("build-queries", help="Genera el query set")
+    build.add_argument("--source", choices=["synthetic", "metrics"], default="synthetic")
+    build.add_argument("--n", type=int, default=200)
+    build.add_argument("--noise", type=float, default=0.3)
+    build.add_argument("--model", default=EMBEDDING_MODEL)
+    build.add_argument("--out", type=Path, default=QUERIES_PATH)
+
+    run = sub.add_parser("run", help="Ejecuta la matriz de configuraciones (offline)")
+    run.add_argument("--queries", type=Path, default=QUERIES_PATH)
+    run.add_argument("--configs", type=Path, default=None)
+    run.add_argument("--k", type=int, default=TOP_K)
+    run.add_argument("--json", type=Path, default=None)
+
+    args = parser.parse_args()
+
+    if args.command == "build-queries":
+        if args.source == "synthetic":
+            queries = synthetic_queries(args.model, args.n, args.noise)
+        else:
+            queries = metrics_queries(args.model, args.n)
+        args.out.parent.mkdir(parents=True, exist_ok=True)
+        args.out.write_text(
+            json.dumps({"model": args.model, "queries": queries}),
+            encoding="utf-8"
+        )
+        print(f"✅ {len(queries)} consultas guardadas en {args.out}")
+    else:
+        data = json.loads(args.queries.read_text(encoding="utf-8"))
+        configs = (
+            json.loads(args.configs.read_text(encoding="utf-8"))
+            if args.configs else DEFAULT_CONFIGS
+        )
+        reports = evaluate(data["queries"], configs, data["model"], args.k)
+        print_table(reports, args.k)
+        if args.json:
+            args.json.write_text(json.dumps(reports, indent=2), encoding="utf-8")
+            print(f"\n💾 Informe JSON en {args.json}")
@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+from openai import OpenAI
+from pgvector import Vector
+from psycopg2.extras import execute_values
+
+from services.db import load_env, get_connection, release_connection
+from services.openai_scheduler import get_scheduler, estimate_tokens, BATCH
+from services.retrieval_service import EMBEDDING_DIMENSIONS, embedding_params
+
+
+# ---------------- CONFIG ----------------
+BATCH_SIZE = 256
+CHECKPOINT_DIR = Path("data/checkpoints")
+
+# ----------------------------------------
+
+def _checkpoint_path(model: str) -> Path:
+    return CHECKPOINT_DIR / f"backfill_{model}.json"
+
+def load_checkpoint(model: str) -> dict:
+    path = _checkpoint_path(model)
+    if path.exists():
+        return json.loads(path.read_text(encoding="utf-8"))
+    return {"model": model, "last_chunk_id": None, "embedded": 0}
+
+def save_checkpoint(model: str, checkpoint: dict):
+    path = _checkpoint_path(model)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Escritura atómica: un crash a mitad no deja un checkpoint corrupto
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(checkpoint), encoding="utf-8")
+    tmp.replace(path)
+
+def count_missing(cur, model: str) -> int:
+    cur.execute(
+        """
+        SELECT count(*)
+        FROM chunks c
+        WHERE NOT EXISTS (
+            SELECT 1 FROM embeddings e
+            WHERE e.chunk_id = c.id AND e.model = %s
+        );
+        """,
+        (model,)
+    )
+    return cur.fetchone()[0]
+
+def fetch_missing(cur, model: str, after_id, limit: int):
+    # Paginación por keyset sobre chunks.id: estable y reanudable
+    sql = """
+        SELECT c.id, c.content
+        FROM chunks c
+        WHERE NOT EXISTS (
+            SELECT 1 FROM embeddings e
+            WHERE e.chunk_id = c.id AND e.model = %s
+        )
+    """
+    params = [model]
+    if after_id is not None:
+        sql += " AND c.id > %s"
+        params.append(after_id)
+    sql += " ORDER BY c.id LIMIT %s;"
+    params.append(limit)
+
+    cur.execute(sql, params)
+    return cur.fetchall()
+
+def insert_embeddings(cur, model: str, rows):
+    execute_values(
+        cur,
+        """
+        INSERT INTO embeddings (chunk_id, embedding, model)
+        VALUES %s;
+        """,
+        [(chunk_id, Vector(embedding), model) for chunk_id, embedding in rows],
+        page_size=len(rows),
+    )
+
+def _format_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}h{(seconds % 3600) // 60:02d}m{seconds % 60:02d}s"
+
+def backfill(
+    model: str,
+    batch_size: int = BATCH_SIZE,
+    limit: int | None = None,
+    dimensions: int = EMBEDDING_DIMENSIONS,
+):
+    """Embebe con `model` todos los chunks que aún no tienen vector para él.
+
+    Reanudable: el checkpoint guarda el último chunk_id procesado y cada
+    lote se confirma antes de avanzar, así que tras un crash se repite como
+    mucho el lote en curso. El ritmo lo fija el scheduler de OpenAI
+    (OPENAI_TPM / OPENAI_MAX_CONCURRENCY) con prioridad BATCH.
+
+    Los vectores se piden con `dimensions` (por defecto 1536, el tamaño de
+    embeddings.embedding) y se validan antes de insertar.
+
+    Requisito previo: un índice vectorial parcial por modelo, para que la
+    búsqueda del modelo actual no recorra vectores del nuevo mientras
+    conviven (ver "Migración de modelo de embeddings" en el README):
+
+        CREATE INDEX CONCURRENTLY embeddings_hnsw_<modelo>
+        ON embeddings USING hnsw (embedding vector_cosine_ops)
+        WHERE model = '<modelo>';
+    """
+    load_env()
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    scheduler = get_scheduler()
+    checkpoint = load_checkpoint(model)
+
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            remaining = count_missing(cur, model)
+        print(f"🧮 Chunks sin embedding para {model}: {remaining}")
+
+        processed = 0
+        start = time.perf_counter()
+        exhausted = False
+
+        while remaining > 0 and (limit is None or processed < limit):
+            with conn.cursor() as cur:
+                batch = fetch_missing(
+                    cur, model, checkpoint["last_chunk_id"], batch_size
+                )
+            if not batch:
+                exhausted = True
+                break
+
+            texts = [content for _, content in batch]
+            params = {"dimensions": dimensions} if embedding_params(model) else {}
+            response = scheduler.call(
+                lambda: client.embeddings.create(model=model, input=texts, **params),
+                priority=BATCH,
+                tokens=estimate_tokens(*texts),
+                kind="embeddings_batch",
+            )
+            vectors = [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+            bad = [len(v) for v in vectors if len(v) != dimensions]
+            if bad:
+                raise ValueError(
+                    f"{model} devolvió vectores de {bad[0]} dimensiones; "
+                    f"la columna espera {dimensions}"
+                )
+
+            with conn.cursor() as cur:
+                insert_embeddings(
+                    cur, model,
+                    [(chunk_id, v) for (chunk_id, _), v in zip(batch, vectors)]
+                )
+
+            processed += len(batch)
+            remaining -= len(batch)
+            checkpoint["last_chunk_id"] = str(batch[-1][0])
+            checkpoint["embedded"] += len(batch)
+            save_checkpoint(model, checkpoint)
+
+            elapsed = time.perf_counter() - start
+            rate = processed / elapsed if elapsed else 0.0
+            eta = _format_eta(remaining / rate) if rate else "?"
+            print(
+                f"📦 {processed} embebidos | {rate:.1f} chunks/s | "
+                f"restantes {max(remaining, 0)} | ETA {eta}"
+            )
+
+        with conn.cursor() as cur:
+            pending = count_missing(cur, model)
+        if pending == 0:
+            print(f"✅ Backfill completo para {model}")
+        else:
+            if exhausted:
+                # Chunks ingestados detrás del cursor: la próxima ejecución
+                # vuelve a recorrer desde el principio
+                checkpoint["last_chunk_id"] = None
+                save_checkpoint(model, checkpoint)
+            print(f"⏸️ Quedan {pending} chunks para {model}; vuelve a ejecutar")
+    finally:
+        release_connection(conn)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Re-embebe los chunks que no tienen vector para un modelo"
+    )
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--dimensions", type=int, default=EMBEDDING_DIMENSIONS)
+    args = parser.parse_args()
+
+    backfill(
+        model=args.model,
+        batch_size=args.batch_size,
+        limit=args.limit,
+        dimensions=args.dimensions,
+    )
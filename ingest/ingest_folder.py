@@ -7,16 +7,17 @@ from pgvector.psycopg2 import register_vector
 from pgvector import Vector
 
 from ingest.loaders import load_document
+from services.openai_scheduler import get_scheduler, estimate_tokens, BATCH
+from services.retrieval_service import ingestion_models, embedding_params
 
 
 # ---------------- CONFIG ----------------
 CHUNK_SIZE = 600
 CHUNK_OVERLAP = 100
-EMBEDDING_MODEL = "text-embedding-3-small"
 
 # ----------------------------------------
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 
 def split_text(text: str):
     chunks = []
@@ -50,6 +51,7 @@ def ingest_file(path: Path, domain: str, module: str, language: str):
         return
     
     chunks = split_text(clean_text)
+    models = ingestion_models()
 
     conn = get_connection()
     cur = conn.cursor()
@@ -77,18 +79,26 @@ def ingest_file(path: Path, domain: str, module: str, language: str):
         )
         chunk_id = cur.fetchone()[0]
 
-        embedding = client.embeddings.create(
-            model=EMBEDDING_MODEL,
-            input=chunk
-        ).data[0].embedding
-
-        cur.execute(
-            """
-            INSERT INTO embeddings (chunk_id, embedding, model)
-            VALUES (%s, %s, %s);
-            """,
-            (chunk_id, Vector(embedding), EMBEDDING_MODEL)
-        )
+        # Con EMBEDDING_MODEL_NEXT definido se guardan ambos vectores
+        for model in models:
+            embedding = get_scheduler().call(
+                lambda: client.embeddings.create(
+                    model=model,
+                    input=chunk,
+                    **embedding_params(model)
+                ),
+                priority=BATCH,
+                tokens=estimate_tokens(chunk),
+                kind="embeddings",
+            ).data[0].embedding
+
+            cur.execute(
+                """
+                INSERT INTO embeddings (chunk_id, embedding, model)
+                VALUES (%s, %s, %s);
+                """,
+                (chunk_id, Vector(embedding), model)
+            )
 
     cur.close()
     conn.close()
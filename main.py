@@ -1,17 +1,29 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel, Field, validator
 from typing import List, Optional
 from fastapi import Depends
 from auth import get_api_key
 
-from services.retrieval_service import answer_question
+from services.db import close_pool
+from services.retrieval_service import answer_question, flush_metrics
+from services.warmup import start_warmup, is_ready, status
 
 # --------------------------------------------------
 # App
 # --------------------------------------------------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # El warm-up corre en segundo plano; /ready indica cuándo termina
+    start_warmup()
+    yield
+    flush_metrics()
+    close_pool()
+
 app = FastAPI(
     title="Knowledge Retrieval API",
     version="1.1.0",
+    lifespan=lifespan,
 )
 
 # --------------------------------------------------
@@ -81,4 +93,8 @@ def ask(
         top_k=request.top_k
     )
 
-
+@app.get("/ready")
+def ready():
+    if not is_ready():
+        raise HTTPException(status_code=503, detail=status())
+    return status()
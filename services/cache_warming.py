@@ -0,0 +1,402 @@
+import argparse
+import time
+from collections import defaultdict
+from typing import List, Dict
+import numpy as np
+import psycopg2.extras
+from pgvector import Vector
+
+from services.db import get_connection, release_connection
+from services.openai_scheduler import estimate_tokens, BATCH
+from services.retrieval_service import (
+    CHAT_MAX_OUTPUT_TOKENS,
+    answer_question,
+    embed_many,
+    get_active_model,
+    get_cached_answer,
+    prime_embedding_cache,
+    store_cached_answer,
+)
+
+# --------------------------------------------------
+# Configuración
+# --------------------------------------------------
+WINDOW_DAYS = 14
+HALF_LIFE_DAYS = 3.0
+CLUSTER_THRESHOLD = 0.92
+MAX_CANDIDATES = 500
+MAX_ANSWERS = 200
+TOKEN_BUDGET = 500_000
+TOP_K = 5
+
+# Warm-up de réplicas: tope de tiempo y tamaño de lote al embeber las
+# preguntas que aún no tienen vector persistido
+REPLICA_TIME_BUDGET = 20.0
+REPLICA_BATCH_SIZE = 64
+
+# Tokens de contexto por fuente (chunks de ~600 caracteres)
+CONTEXT_TOKENS_PER_SOURCE = 150
+
+# --------------------------------------------------
+# Minado de query_metrics
+# --------------------------------------------------
+def mine_questions(
+    window_days: int = WINDOW_DAYS,
+    half_life_days: float = HALF_LIFE_DAYS,
+    limit: int = MAX_CANDIDATES,
+) -> List[Dict]:
+    """Las `limit` preguntas más pesadas de la ventana (frecuencia con decaimiento).
+
+    Incluye los aciertos de cache (mode = 'cache'), así que la frecuencia
+    refleja el tráfico real y no solo los fallos.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT
+                    question, domain, module, language, hits, age_days,
+                    hits * power(0.5, age_days / %s) AS weight
+                FROM (
+                    SELECT
+                        question, domain, module, language,
+                        count(*) AS hits,
+                        EXTRACT(EPOCH FROM now() - max(created_at)) / 86400 AS age_days
+                    FROM query_metrics
+                    WHERE created_at >= now() - %s * interval '1 day'
+                    GROUP BY question, domain, module, language
+                ) q
+                ORDER BY weight DESC
+                LIMIT %s;
+                """,
+                (half_life_days, window_days, limit)
+            )
+            rows = cur.fetchall()
+    finally:
+        release_connection(conn)
+
+    return [
+        {
+            "question": q,
+            "domain": d,
+            "module": m,
+            "language": l,
+            "hits": hits,
+            "age_days": float(age),
+            "weight": float(weight),
+        }
+        for q, d, m, l, hits, age, weight in rows
+    ]
+
+def count_window_queries(window_days: int = WINDOW_DAYS) -> int:
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT count(*)
+                FROM query_metrics
+                WHERE created_at >= now() - %s * interval '1 day';
+                """,
+                (window_days,)
+            )
+            return cur.fetchone()[0]
+    finally:
+        release_connection(conn)
+
+def cached_questions(window_days: int = WINDOW_DAYS, limit: int = MAX_CANDIDATES) -> List[str]:
+    """Las preguntas más pedidas de la ventana que ya tienen fila en answer_cache."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT q.question
+                FROM (
+                    SELECT question, domain, module, language, count(*) AS hits
+                    FROM query_metrics
+                    WHERE created_at >= now() - %s * interval '1 day'
+                    GROUP BY question, domain, module, language
+                ) q
+                JOIN answer_cache a
+                  ON a.question = q.question
+                 AND a.domain = q.domain
+                 AND a.module IS NOT DISTINCT FROM q.module
+                 AND a.language IS NOT DISTINCT FROM q.language
+                ORDER BY q.hits DESC
+                LIMIT %s;
+                """,
+                (window_days, limit)
+            )
+            rows = cur.fetchall()
+    finally:
+        release_connection(conn)
+    return list(dict.fromkeys(r[0] for r in rows))
+
+def _normalize_question(text: str) -> str:
+    # Misma equivalencia que la clave de answer_cache, salvo espacios
+    return " ".join(text.lower().split())
+
+# --------------------------------------------------
+# Vectores persistidos (query_embeddings)
+# --------------------------------------------------
+def load_query_embeddings(model: str, texts: List[str]) -> Dict[str, Vector]:
+    if not texts:
+        return {}
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT text, embedding
+                FROM query_embeddings
+                WHERE model = %s AND text = ANY(%s);
+                """,
+                (model, list(texts))
+            )
+            # El cast de pgvector devuelve ndarray; la cache en proceso guarda Vector
+            return {text: Vector(emb) for text, emb in cur.fetchall()}
+    finally:
+        release_connection(conn)
+
+def save_query_embeddings(model: str, vectors: Dict[str, Vector]) -> int:
+    if not vectors:
+        return 0
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(
+                cur,
+                """
+                INSERT INTO query_embeddings (model, text, embedding)
+                VALUES %s
+                ON CONFLICT (model, text) DO NOTHING;
+                """,
+                [(model, text, vector) for text, vector in vectors.items()]
+            )
+    finally:
+        release_connection(conn)
+    return len(vectors)
+
+# --------------------------------------------------
+# Clustering de casi duplicados
+# --------------------------------------------------
+def cluster_questions(
+    entries: List[Dict],
+    vectors: List,
+    threshold: float = CLUSTER_THRESHOLD,
+) -> List[Dict]:
+    """Agrupa preguntas casi idénticas dentro de un mismo (domain, module, language).
+
+    Clustering voraz por peso: la pregunta más pesada abre un cluster y
+    absorbe las restantes con similitud coseno >= `threshold`. Solo se
+    calcula la fila de similitudes de cada representante, así que la
+    memoria es lineal en el número de preguntas.
+    """
+    groups = defaultdict(list)
+    for e, v in zip(entries, vectors):
+        groups[(e["domain"], e["module"], e["language"])].append((e, v))
+
+    clusters = []
+    for (domain, module, language), members in groups.items():
+        members.sort(key=lambda m: m[0]["weight"], reverse=True)
+        emb = np.asarray([v.to_numpy() for _, v in members], dtype=np.float32)
+        emb /= np.linalg.norm(emb, axis=1, keepdims=True) + 1e-12
+
+        assigned = np.zeros(len(members), dtype=bool)
+        for i in range(len(members)):
+            if assigned[i]:
+                continue
+            idx = np.flatnonzero(~assigned & (emb @ emb[i] >= threshold))
+            assigned[idx] = True
+            variants = [members[j][0] for j in idx]
+            clusters.append({
+                "domain": domain,
+                "module": module,
+                "language": language,
+                "representative": members[i][0]["question"],
+                "variants": [
+                    {"question": v["question"], "hits": v["hits"]}
+                    for v in variants
+                ],
+                "hits": sum(v["hits"] for v in variants),
+                "weight": sum(v["weight"] for v in variants),
+            })
+
+    clusters.sort(key=lambda c: c["weight"], reverse=True)
+    return clusters
+
+# --------------------------------------------------
+# Warming
+# --------------------------------------------------
+def _estimated_tokens(question: str, top_k: int) -> int:
+    return (
+        estimate_tokens(question)
+        + top_k * CONTEXT_TOKENS_PER_SOURCE
+        + CHAT_MAX_OUTPUT_TOKENS
+    )
+
+def warm_cache(
+    window_days: int = WINDOW_DAYS,
+    max_candidates: int = MAX_CANDIDATES,
+    max_answers: int = MAX_ANSWERS,
+    token_budget: int = TOKEN_BUDGET,
+    top_k: int = TOP_K,
+    threshold: float = CLUSTER_THRESHOLD,
+) -> Dict:
+    """Regenera las respuestas de los clusters más pesados y llena las caches.
+
+    El clustering solo ordena: los casi duplicados suman peso una vez. La
+    respuesta se copia únicamente a las variantes con el mismo texto
+    normalizado, nunca a preguntas distintas aunque se parezcan. Solo se
+    embeben las candidatas sin vector en query_embeddings (su coste cuenta
+    dentro de `token_budget`) y los vectores nuevos se persisten para que
+    las réplicas los carguen sin llamar a OpenAI (warm_replica).
+    """
+    start = time.perf_counter()
+    entries = mine_questions(window_days, limit=max_candidates)
+    total_queries = count_window_queries(window_days)
+    if not entries:
+        print("⚠️ query_metrics no tiene preguntas en la ventana")
+        return {"clusters": 0, "expected_hit_rate": 0.0}
+
+    # Los vectores ya persistidos no cuestan tokens; del resto se recortan
+    # las preguntas (ordenadas por peso) que no caben en el presupuesto
+    model = get_active_model()
+    persisted = load_query_embeddings(model, [e["question"] for e in entries])
+    prime_embedding_cache(model, persisted)
+
+    spent_tokens = 0
+    affordable = []
+    missing = {}
+    for e in entries:
+        question = e["question"]
+        if question not in persisted and question not in missing:
+            cost = estimate_tokens(question)
+            if spent_tokens + cost > token_budget:
+                continue
+            spent_tokens += cost
+            missing[question] = None
+        affordable.append(e)
+    entries = affordable
+
+    fresh = dict(zip(missing, embed_many(list(missing), model=model, priority=BATCH)))
+    save_query_embeddings(model, fresh)
+    by_text = {**persisted, **fresh}
+    vectors = [by_text[e["question"]] for e in entries]
+    clusters = cluster_questions(entries, vectors, threshold)
+    print(f"🧩 {len(entries)} preguntas candidatas → {len(clusters)} clusters")
+
+    generated = 0
+    reused = 0
+    covered_hits = 0
+
+    for c in clusters:
+        key = (c["domain"], c["module"], c["language"])
+        cached = get_cached_answer(c["representative"], *key)
+
+        if not cached:
+            cost = _estimated_tokens(c["representative"], top_k)
+            if generated >= max_answers or spent_tokens + cost > token_budget:
+                continue
+            cached = answer_question(
+                c["representative"], *key,
+                top_k=top_k,
+                priority=BATCH,
+                log_metrics=False,
+            )
+            spent_tokens += cost
+            generated += 1
+            # Sin contexto suficiente no se cachea nada
+            if not cached["sources"]:
+                continue
+        else:
+            reused += 1
+
+        normalized = _normalize_question(c["representative"])
+        for variant in c["variants"]:
+            if _normalize_question(variant["question"]) != normalized:
+                continue
+            if variant["question"] != c["representative"]:
+                store_cached_answer(
+                    variant["question"], *key,
+                    cached["answer"], cached["sources"]
+                )
+            covered_hits += variant["hits"]
+
+    report = {
+        "questions": len(entries),
+        "clusters": len(clusters),
+        "generated": generated,
+        "reused": reused,
+        "estimated_tokens": spent_tokens,
+        "expected_hit_rate": covered_hits / total_queries if total_queries else 0.0,
+        "duration_s": round(time.perf_counter() - start, 1),
+    }
+    print(
+        f"🔥 Warming: {generated} generadas, {reused} reutilizadas, "
+        f"~{spent_tokens} tokens | hit rate esperado "
+        f"{report['expected_hit_rate']:.1%}"
+    )
+    return report
+
+def warm_replica(
+    time_budget: float = REPLICA_TIME_BUDGET,
+    window_days: int = WINDOW_DAYS,
+    limit: int = MAX_CANDIDATES,
+    batch_size: int = REPLICA_BATCH_SIZE,
+) -> Dict:
+    """Llena la cache de embeddings de una réplica al arrancar.
+
+    Solo considera preguntas con respuesta ya en answer_cache y no genera
+    ninguna. Los vectores salen de query_embeddings (los persiste
+    warm_cache); las que falten se embeben por lotes hasta agotar
+    `time_budget`, que se comprueba entre lotes.
+    """
+    deadline = time.monotonic() + time_budget
+    questions = cached_questions(window_days, limit)
+    model = get_active_model()
+    persisted = load_query_embeddings(model, questions)
+    prime_embedding_cache(model, persisted)
+
+    missing = [q for q in questions if q not in persisted]
+    embedded = 0
+    for i in range(0, len(missing), batch_size):
+        if time.monotonic() >= deadline:
+            print(f"⏱️ Tope de {time_budget:.0f}s alcanzado; quedan {len(missing) - embedded} sin vector")
+            break
+        batch = missing[i:i + batch_size]
+        fresh = dict(zip(batch, embed_many(batch, model=model, priority=BATCH)))
+        save_query_embeddings(model, fresh)
+        embedded += len(fresh)
+
+    print(f"🧠 Embeddings de preguntas: {len(persisted)} cargados, {embedded} nuevos")
+    return {
+        "questions": len(questions),
+        "loaded": len(persisted),
+        "embedded": embedded,
+        "pending": len(missing) - embedded,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precalienta answer_cache con las preguntas de query_metrics"
+    )
+    parser.add_argument("--window-days", type=int, default=WINDOW_DAYS)
+    parser.add_argument("--max-candidates", type=int, default=MAX_CANDIDATES)
+    parser.add_argument("--max-answers", type=int, default=MAX_ANSWERS)
+    parser.add_argument("--token-budget", type=int, default=TOKEN_BUDGET)
+    parser.add_argument("--top-k", type=int, default=TOP_K)
+    parser.add_argument("--threshold", type=float, default=CLUSTER_THRESHOLD)
+    args = parser.parse_args()
+
+    warm_cache(
+        window_days=args.window_days,
+        max_candidates=args.max_candidates,
+        max_answers=args.max_answers,
+        token_budget=args.token_budget,
+        top_k=args.top_k,
+        threshold=args.threshold,
+    )
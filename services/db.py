@@ -0,0 +1,100 @@
+import os
+import threading
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from dotenv import load_dotenv
+from pgvector.psycopg2 import register_vector
+
+# --------------------------------------------------
+# Entorno (se carga una sola vez, bajo demanda)
+# --------------------------------------------------
+_env_loaded = False
+_env_lock = threading.Lock()
+
+def load_env():
+    global _env_loaded
+    if _env_loaded:
+        return
+    with _env_lock:
+        if not _env_loaded:
+            load_dotenv()
+            _env_loaded = True
+
+# --------------------------------------------------
+# Pool de conexiones (lazy)
+# --------------------------------------------------
+class _VectorConnection(psycopg2.extensions.connection):
+    # Marca si ya se registraron los tipos de pgvector en esta conexión
+    vector_registered = False
+
+_pool = None
+_slots = None
+_pool_lock = threading.Lock()
+
+def pool_size() -> tuple[int, int]:
+    load_env()
+    min_size = int(os.getenv("POSTGRES_POOL_MIN", "2"))
+    # FastAPI atiende los endpoints síncronos con ~40 hilos
+    max_size = int(os.getenv("POSTGRES_POOL_MAX", "40"))
+    return min_size, max(min_size, max_size)
+
+def _get_pool() -> ThreadedConnectionPool:
+    global _pool, _slots
+    if _pool is not None:
+        return _pool
+    with _pool_lock:
+        if _pool is None:
+            min_size, max_size = pool_size()
+            _pool = ThreadedConnectionPool(
+                min_size,
+                max_size,
+                dbname=os.getenv("POSTGRES_DB"),
+                user=os.getenv("POSTGRES_USER"),
+                password=os.getenv("POSTGRES_PASSWORD"),
+                host="localhost",
+                port=os.getenv("POSTGRES_PORT"),
+                connection_factory=_VectorConnection,
+            )
+            # ThreadedConnectionPool.getconn falla en el acto si está lleno;
+            # el semáforo hace que el checkout espere a que se libere una
+            _slots = threading.BoundedSemaphore(max_size)
+    return _pool
+
+def get_connection():
+    pool = _get_pool()
+    timeout = float(os.getenv("POSTGRES_POOL_TIMEOUT", "30"))
+    if not _slots.acquire(timeout=timeout):
+        raise PoolError(f"Sin conexiones libres tras {timeout:.0f}s")
+
+    try:
+        conn = pool.getconn()
+    except Exception:
+        _slots.release()
+        raise
+
+    try:
+        if not conn.autocommit:
+            conn.autocommit = True
+        if not conn.vector_registered:
+            register_vector(conn)
+            conn.vector_registered = True
+    except Exception:
+        release_connection(conn, discard=True)
+        raise
+    return conn
+
+def release_connection(conn, discard: bool = False):
+    # Las conexiones rotas se descartan en lugar de volver al pool
+    try:
+        _get_pool().putconn(conn, close=discard or bool(conn.closed))
+    finally:
+        _slots.release()
+
+def close_pool():
+    global _pool, _slots
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _slots = None
@@ -0,0 +1,368 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+import psycopg2
+from openai import (
+    RateLimitError,
+    APITimeoutError,
+    APIConnectionError,
+    InternalServerError,
+)
+from tenacity import (
+    Retrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from services.db import load_env, get_connection, release_connection
+
+# --------------------------------------------------
+# Prioridades (menor = antes)
+# --------------------------------------------------
+INTERACTIVE = 0   # /ask
+BATCH = 1         # ingesta, backfill, warming
+
+# Fracción máxima de la concurrencia que puede ocupar el trabajo BATCH,
+# para que siempre quede hueco para /ask
+BATCH_SHARE = 0.75
+
+# Presupuesto compartido: fracción del bucket que el trabajo BATCH no puede
+# consumir, y cuánto tiempo bloquea a BATCH una petición INTERACTIVE que
+# tuvo que esperar o un 429 de cualquier proceso
+INTERACTIVE_RESERVE = 0.2
+INTERACTIVE_HOLD_SECONDS = 2.0
+THROTTLE_HOLD_SECONDS = 10.0
+MAX_SHARED_WAIT = 5.0
+# Tope de espera de /ask por el presupuesto compartido; pasado este tiempo
+# sigue solo con el bucket local del proceso
+MAX_INTERACTIVE_SHARED_WAIT = 10.0
+
+RETRYABLE_ERRORS = (
+    RateLimitError,
+    APITimeoutError,
+    APIConnectionError,
+    InternalServerError,
+)
+
+def estimate_tokens(*texts: str) -> int:
+    # Aproximación barata (~4 caracteres por token); basta para el presupuesto
+    return sum(len(t) for t in texts) // 4 + 1
+
+
+class SharedTokenBudget:
+    """Bucket de tokens por minuto compartido entre procesos vía Postgres.
+
+    La API, la ingesta y el backfill consumen de la misma fila de
+    openai_budget (tabla documentada en el README; la app no ejecuta DDL).
+    INTERACTIVE puede vaciar el bucket; BATCH solo toma tokens si queda por
+    encima de la reserva, si ninguna petición INTERACTIVE ha tenido que
+    esperar en los últimos segundos y si no hay un 429 reciente en ningún
+    proceso. Conceder tokens es un único UPDATE en autocommit.
+    """
+
+    # Nivel actual del bucket, recargado según el tiempo transcurrido
+    _LEVEL = """
+        LEAST(
+            %(cap)s,
+            tokens + GREATEST(
+                EXTRACT(EPOCH FROM clock_timestamp() - refilled_at), 0
+            ) * %(rate)s
+        )
+    """
+
+    def __init__(
+        self,
+        tokens_per_minute: int,
+        name: str = "openai",
+        interactive_reserve: float = INTERACTIVE_RESERVE,
+    ):
+        self.tokens_per_minute = tokens_per_minute
+        self.name = name
+        self.reserve = tokens_per_minute * interactive_reserve
+
+    def take(self, tokens: int, priority: int) -> float:
+        """Intenta consumir `tokens`; devuelve 0 si se conceden o los segundos a esperar."""
+        cap = float(self.tokens_per_minute)
+        interactive = priority <= INTERACTIVE
+        need = min(float(tokens), cap if interactive else cap - self.reserve)
+        params = {
+            "cap": cap,
+            "rate": cap / 60.0,
+            "need": need,
+            "reserve": self.reserve,
+            "hold": INTERACTIVE_HOLD_SECONDS,
+            "name": self.name,
+        }
+
+        if interactive:
+            grant = f"{self._LEVEL} >= %(need)s"
+        else:
+            grant = f"""
+                {self._LEVEL} - %(need)s >= %(reserve)s
+                AND interactive_waiting_until <= clock_timestamp()
+                AND throttled_until <= clock_timestamp()
+            """
+
+        conn = get_connection()
+        try:
+            with conn.cursor() as cur:
+                # Camino rápido: el WHERE se reevalúa sobre la versión más
+                # reciente de la fila, así que dos procesos no conceden lo mismo
+                cur.execute(
+                    f"""
+                    UPDATE openai_budget
+                    SET tokens = {self._LEVEL} - %(need)s,
+                        refilled_at = clock_timestamp()
+                    WHERE name = %(name)s AND {grant}
+                    RETURNING tokens;
+                    """,
+                    params
+                )
+                if cur.fetchone():
+                    return 0.0
+
+                # Sin tokens: INTERACTIVE además avisa a BATCH de que espere
+                if interactive:
+                    cur.execute(
+                        f"""
+                        UPDATE openai_budget
+                        SET interactive_waiting_until = GREATEST(
+                            interactive_waiting_until,
+                            clock_timestamp() + make_interval(secs => %(hold)s)
+                        )
+                        WHERE name = %(name)s
+                        RETURNING {self._LEVEL}, 0;
+                        """,
+                        params
+                    )
+                else:
+                    cur.execute(
+                        f"""
+                        SELECT
+                            {self._LEVEL},
+                            GREATEST(
+                                EXTRACT(EPOCH FROM interactive_waiting_until - clock_timestamp()),
+                                EXTRACT(EPOCH FROM throttled_until - clock_timestamp()),
+                                0
+                            )
+                        FROM openai_budget
+                        WHERE name = %(name)s;
+                        """,
+                        params
+                    )
+                row = cur.fetchone()
+                if row is None:
+                    # Primera ejecución: se siembra la fila y se concede
+                    cur.execute(
+                        """
+                        INSERT INTO openai_budget (name, tokens)
+                        VALUES (%s, %s)
+                        ON CONFLICT (name) DO NOTHING;
+                        """,
+                        (self.name, cap)
+                    )
+                    return 0.0
+
+                level, blocked = float(row[0]), float(row[1])
+                reserve = 0.0 if interactive else self.reserve
+                return max(blocked, (need + reserve - level) / params["rate"], 0.01)
+        finally:
+            release_connection(conn)
+
+    def report_throttled(self):
+        conn = get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE openai_budget
+                    SET throttled_until = clock_timestamp() + make_interval(secs => %s)
+                    WHERE name = %s;
+                    """,
+                    (THROTTLE_HOLD_SECONDS, self.name)
+                )
+        finally:
+            release_connection(conn)
+
+
+class OpenAIScheduler:
+    """Limita las llamadas a OpenAI por concurrencia y tokens por minuto.
+
+    La concurrencia se adapta (AIMD): sube de forma aditiva mientras la
+    latencia se mantiene cerca de su media y baja a la mitad ante un 429.
+    Los waiters se atienden por prioridad y, dentro de ella, por orden de
+    llegada. La concurrencia es por proceso; los tokens por minuto se
+    coordinan entre procesos con `shared_budget` (SharedTokenBudget). El
+    bucket local solo limita si Postgres no está disponible.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 16,
+        min_concurrency: int = 1,
+        tokens_per_minute: int = 1_000_000,
+        max_attempts: int = 5,
+        shared_budget: SharedTokenBudget | None = None,
+    ):
+        self.shared_budget = shared_budget
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_attempts = max_attempts
+
+        self._limit = float(max_concurrency)
+        self._in_flight = 0
+        self._tokens = float(tokens_per_minute)
+        self._refilled_at = time.monotonic()
+        self._latency_avg = {}
+        self._cooldown_until = 0.0
+
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = itertools.count()
+
+    # ---------------- slots ----------------
+    def _refill(self, now: float):
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        self._tokens = min(
+            float(self.tokens_per_minute),
+            self._tokens + elapsed * self.tokens_per_minute / 60.0,
+        )
+
+    def _slot_limit(self, priority: int) -> int:
+        limit = max(self.min_concurrency, int(self._limit))
+        if priority > INTERACTIVE:
+            return max(1, int(limit * BATCH_SHARE))
+        return limit
+
+    def _acquire(self, priority: int, tokens: int):
+        tokens = min(tokens, self.tokens_per_minute)
+        entry = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    timeout = None
+                    if self._waiters[0] == entry and self._in_flight < self._slot_limit(priority):
+                        if self._tokens >= tokens:
+                            break
+                        deficit = tokens - self._tokens
+                        timeout = deficit * 60.0 / self.tokens_per_minute
+                    self._cond.wait(timeout)
+                self._in_flight += 1
+                self._tokens -= tokens
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def _release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    # ---------------- adaptación ----------------
+    def _on_success(self, kind: str, latency: float):
+        with self._cond:
+            avg = self._latency_avg.get(kind)
+            self._latency_avg[kind] = latency if avg is None else 0.9 * avg + 0.1 * latency
+
+            if avg is not None and latency > 2 * avg:
+                self._limit = max(self.min_concurrency, self._limit * 0.9)
+            elif time.monotonic() >= self._cooldown_until:
+                self._limit = min(self.max_concurrency, self._limit + 1.0 / self._limit)
+            self._cond.notify_all()
+
+    def _on_rate_limited(self):
+        with self._cond:
+            self._limit = max(self.min_concurrency, self._limit / 2)
+            self._cooldown_until = time.monotonic() + 10.0
+
+    # ---------------- presupuesto compartido ----------------
+    def _take_shared(self, priority: int, tokens: int):
+        if self.shared_budget is None:
+            return
+        deadline = None
+        if priority <= INTERACTIVE:
+            deadline = time.monotonic() + MAX_INTERACTIVE_SHARED_WAIT
+        while True:
+            try:
+                wait = self.shared_budget.take(tokens, priority)
+            except psycopg2.Error as e:
+                # Sin Postgres no se bloquea /ask: queda el bucket local
+                print(f"⚠️ Presupuesto compartido no disponible: {e}")
+                return
+            if wait <= 0:
+                return
+            wait = min(wait, MAX_SHARED_WAIT)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print("⚠️ Presupuesto compartido agotado; /ask sigue con el bucket local")
+                    return
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    def _report_throttled(self):
+        if self.shared_budget is None:
+            return
+        try:
+            self.shared_budget.report_throttled()
+        except psycopg2.Error as e:
+            print(f"⚠️ No se pudo registrar el 429: {e}")
+
+    # ---------------- API ----------------
+    @property
+    def concurrency_limit(self) -> int:
+        return max(self.min_concurrency, int(self._limit))
+
+    def call(self, fn, *, priority: int = INTERACTIVE, tokens: int = 1, kind: str = "default"):
+        """Ejecuta `fn()` bajo el scheduler, con reintentos y backoff con jitter."""
+        for attempt in Retrying(
+            retry=retry_if_exception_type(RETRYABLE_ERRORS),
+            wait=wait_random_exponential(multiplier=0.5, max=20),
+            stop=stop_after_attempt(self.max_attempts),
+            reraise=True,
+        ):
+            with attempt:
+                self._take_shared(priority, tokens)
+                self._acquire(priority, tokens)
+                start = time.monotonic()
+                try:
+                    result = fn()
+                except RateLimitError:
+                    self._on_rate_limited()
+                    self._report_throttled()
+                    raise
+                finally:
+                    self._release()
+                self._on_success(kind, time.monotonic() - start)
+                return result
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler() -> OpenAIScheduler:
+    global _scheduler
+    if _scheduler is not None:
+        return _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            load_env()
+            tokens_per_minute = int(os.getenv("OPENAI_TPM", "1000000"))
+            shared = None
+            if os.getenv("OPENAI_SHARED_BUDGET", "true").lower() == "true":
+                shared = SharedTokenBudget(tokens_per_minute)
+            _scheduler = OpenAIScheduler(
+                max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", "16")),
+                tokens_per_minute=tokens_per_minute,
+                shared_budget=shared,
+            )
+    return _scheduler
@@ -3,45 +3,253 @@ import psycopg2
 import psycopg2.extras
 import math
 import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
-from dotenv import load_dotenv
+import numpy as np
 from openai import OpenAI
-from pgvector.psycopg2 import register_vector
 from pgvector import Vector
 
+from services.db import load_env, get_connection, release_connection
+from services.openai_scheduler import get_scheduler, estimate_tokens, INTERACTIVE, BATCH
+
 # --------------------------------------------------
 # Configuración
 # --------------------------------------------------
 EMBEDDING_MODEL = "text-embedding-3-small"
+# embeddings.embedding es VECTOR(1536): todos los modelos deben producir esto
+EMBEDDING_DIMENSIONS = 1536
 CHAT_MODEL = "gpt-4.1-mini"
+CHAT_MAX_OUTPUT_TOKENS = 800
+
+STRICT_THRESHOLD = 0.35
+FALLBACK_THRESHOLD = 0.25
+
+ANSWER_MEMO_SIZE = 1024
+# Tras borrar filas de answer_cache, las réplicas dejan de servirlas como
+# mucho pasado este tiempo
+ANSWER_MEMO_TTL = 60
+# Las respuestas precargadas en el warm-up duran más: son las más pedidas y
+# deben cubrir el arranque en frío, no solo su primer minuto
+ANSWER_PRELOAD_TTL = 900
+ANSWER_PRELOAD_WINDOW_DAYS = 7
+EMBEDDING_MEMO_SIZE = 2048
+
+# Migración de modelo: se sirve con EMBEDDING_MODEL hasta que el backfill
+# (ingest.backfill_embeddings) cubra todos los chunks con EMBEDDING_MODEL_NEXT
+MODEL_CHECK_INTERVAL = 300
+
+# Reranking: "mmr" (diversidad) o "length" (heurística histórica)
+DEFAULT_RERANK = "mmr"
+MMR_LAMBDA = 0.7
+MMR_DUPLICATE_THRESHOLD = 0.95
+
+# Parámetros de sesión que search_by_vector acepta (p. ej. para evaluar ANN)
+SEARCH_SESSION_SETTINGS = {"hnsw.ef_search", "ivfflat.probes", "enable_indexscan"}
+
+# query_metrics se escribe fuera del camino de la petición; con Postgres
+# caído se descartan las métricas que no quepan en la cola
+METRICS_WORKERS = 2
+METRICS_MAX_PENDING = 1000
 
-load_dotenv()
-_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# --------------------------------------------------
+# Cliente OpenAI (lazy)
+# --------------------------------------------------
+_client = None
+_client_lock = threading.Lock()
+
+def _get_client() -> OpenAI:
+    global _client
+    if _client is not None:
+        return _client
+    with _client_lock:
+        if _client is None:
+            load_env()
+            # Los reintentos los gestiona el scheduler
+            _client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return _client
 
 # --------------------------------------------------
-# DB helpers
+# Caches en proceso (LRU)
 # --------------------------------------------------
-def _get_connection():
-    conn = psycopg2.connect(
-        dbname=os.getenv("POSTGRES_DB"),
-        user=os.getenv("POSTGRES_USER"),
-        password=os.getenv("POSTGRES_PASSWORD"),
-        host="localhost",
-        port=os.getenv("POSTGRES_PORT"),
-    )
-    conn.autocommit = True
-    register_vector(conn)
-    return conn
+class _LRUCache:
+    def __init__(self, max_size: int, ttl: float | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            value, expires_at = self._data[key]
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl: float | None = None):
+        ttl = ttl or self.ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+_answer_memo = _LRUCache(ANSWER_MEMO_SIZE, ttl=ANSWER_MEMO_TTL)
+_embedding_memo = _LRUCache(EMBEDDING_MEMO_SIZE)
+
+# --------------------------------------------------
+# Modelo de embeddings activo
+# --------------------------------------------------
+# -inf: la primera llamada comprueba siempre, sea cual sea el uptime del host
+_active_model = {"name": EMBEDDING_MODEL, "checked_at": float("-inf")}
+_active_model_lock = threading.Lock()
+
+def _next_model_complete(model: str) -> bool:
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT NOT EXISTS (
+                    SELECT 1 FROM chunks c
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM embeddings e
+                        WHERE e.chunk_id = c.id AND e.model = %s
+                    )
+                );
+                """,
+                (model,)
+            )
+            return cur.fetchone()[0]
+    finally:
+        release_connection(conn)
+
+def get_active_model() -> str:
+    load_env()
+    next_model = os.getenv("EMBEDDING_MODEL_NEXT")
+    if not next_model or _active_model["name"] == next_model:
+        return _active_model["name"]
+
+    now = time.monotonic()
+    if now - _active_model["checked_at"] < MODEL_CHECK_INTERVAL:
+        return _active_model["name"]
+
+    with _active_model_lock:
+        if now - _active_model["checked_at"] >= MODEL_CHECK_INTERVAL:
+            _active_model["checked_at"] = now
+            try:
+                complete = _next_model_complete(next_model)
+            except psycopg2.Error as e:
+                print(f"⚠️ No se pudo comprobar {next_model}: {e}")
+                complete = False
+            if complete:
+                print(f"🔀 Cambio de modelo de embeddings → {next_model}")
+                _active_model["name"] = next_model
+    return _active_model["name"]
+
+def ingestion_models() -> List[str]:
+    """Modelos con los que debe embeberse todo chunk nuevo.
+
+    Durante una migración se escriben ambos vectores: el modelo actual sigue
+    sirviendo y el nuevo no pierde cobertura por lo ingestado entretanto.
+    """
+    load_env()
+    models = [EMBEDDING_MODEL]
+    next_model = os.getenv("EMBEDDING_MODEL_NEXT")
+    if next_model and next_model != EMBEDDING_MODEL:
+        models.append(next_model)
+    return models
 
 # --------------------------------------------------
 # Embeddings
 # --------------------------------------------------
-def _embed(text: str) -> Vector:
-    response = _client.embeddings.create(
-        model=EMBEDDING_MODEL,
-        input=text
+def embedding_params(model: str, dimensions: int = EMBEDDING_DIMENSIONS) -> Dict:
+    """Parámetros extra de embeddings.create para que el vector quepa en la columna.
+
+    Los modelos text-embedding-3-* aceptan `dimensions` (p. ej. -large, de
+    3072 nativos, se reduce a 1536); los anteriores solo dan su tamaño nativo.
+    """
+    if model.startswith("text-embedding-3"):
+        return {"dimensions": dimensions}
+    return {}
+
+def _embed(
+    text: str,
+    model: str = EMBEDDING_MODEL,
+    priority: int = INTERACTIVE
+) -> Vector:
+    # strict y fallback embeben la misma pregunta: se reutiliza el vector
+    cached = _embedding_memo.get((model, text))
+    if cached is not None:
+        return cached
+
+    response = get_scheduler().call(
+        lambda: _get_client().embeddings.create(
+            model=model,
+            input=text,
+            **embedding_params(model)
+        ),
+        priority=priority,
+        tokens=estimate_tokens(text),
+        kind="embeddings",
     )
-    return Vector(response.data[0].embedding)
+    vector = Vector(response.data[0].embedding)
+    _embedding_memo.put((model, text), vector)
+    return vector
+
+def embed_many(
+    texts: List[str],
+    model: str | None = None,
+    priority: int = BATCH,
+    batch_size: int = 256
+) -> List[Vector]:
+    """Embebe varios textos en lotes y deja los vectores en la cache en proceso."""
+    model = model or get_active_model()
+    vectors = {}
+    missing = []
+    for text in dict.fromkeys(texts):
+        cached = _embedding_memo.get((model, text))
+        if cached is not None:
+            vectors[text] = cached
+        else:
+            missing.append(text)
+
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i:i + batch_size]
+        response = get_scheduler().call(
+            lambda: _get_client().embeddings.create(
+                model=model, input=batch, **embedding_params(model)
+            ),
+            priority=priority,
+            tokens=estimate_tokens(*batch),
+            kind="embeddings_batch",
+        )
+        for d in response.data:
+            vector = Vector(d.embedding)
+            vectors[batch[d.index]] = vector
+            _embedding_memo.put((model, batch[d.index]), vector)
+
+    return [vectors[t] for t in texts]
+
+def prime_embedding_cache(model: str, vectors: Dict[str, Vector]) -> int:
+    """Carga vectores ya calculados (p. ej. de query_embeddings) en la cache en proceso."""
+    for text, vector in vectors.items():
+        _embedding_memo.put((model, text), vector)
+    return len(vectors)
 
 # --------------------------------------------------
 # Cache helpers
@@ -51,7 +259,11 @@ def _cache_key(question, domain, module, language):
     return hashlib.sha1(raw.lower().encode()).hexdigest()
 
 def _get_cached_answer(cache_key: str):
-    conn = _get_connection()
+    memo = _answer_memo.get(cache_key)
+    if memo is not None:
+        return {**memo, "cached": True}
+
+    conn = get_connection()
     try:
         with conn.cursor() as cur:
             cur.execute(
@@ -64,13 +276,16 @@ def _get_cached_answer(cache_key: str):
             )
             row = cur.fetchone()
             if row:
+                _answer_memo.put(
+                    cache_key, {"answer": row[0], "sources": row[1]}
+                )
                 return {
                     "answer": row[0],
                     "sources": row[1],
                     "cached": True
                 }
     finally:
-        conn.close()
+        release_connection(conn)
     return None
 
 def _save_cache(
@@ -82,7 +297,9 @@ def _save_cache(
     answer: str,
     sources: List[Dict]
 ):
-    conn = _get_connection()
+    _answer_memo.put(cache_key, {"answer": answer, "sources": sources})
+
+    conn = get_connection()
     try:
         with conn.cursor() as cur:
             cur.execute(
@@ -104,7 +321,69 @@ def _save_cache(
                 )
             )
     finally:
-        conn.close()
+        release_connection(conn)
+
+def get_cached_answer(
+    question: str,
+    domain: str,
+    module: str | None,
+    language: str
+):
+    return _get_cached_answer(_cache_key(question, domain, module, language))
+
+def store_cached_answer(
+    question: str,
+    domain: str,
+    module: str | None,
+    language: str,
+    answer: str,
+    sources: List[Dict]
+):
+    _save_cache(
+        _cache_key(question, domain, module, language),
+        question, domain, module, language, answer, sources
+    )
+
+def preload_answer_cache(limit: int = ANSWER_MEMO_SIZE) -> int:
+    """Carga en memoria las `limit` respuestas cacheadas más pedidas.
+
+    El orden sale de la frecuencia reciente en query_metrics; las entradas
+    precargadas expiran a los ANSWER_PRELOAD_TTL segundos.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT a.cache_key, a.answer, a.sources
+                FROM answer_cache a
+                JOIN (
+                    SELECT question, domain, module, language, count(*) AS hits
+                    FROM query_metrics
+                    WHERE created_at >= now() - %s * interval '1 day'
+                    GROUP BY question, domain, module, language
+                ) q
+                  ON q.question = a.question
+                 AND q.domain = a.domain
+                 AND q.module IS NOT DISTINCT FROM a.module
+                 AND q.language IS NOT DISTINCT FROM a.language
+                ORDER BY q.hits DESC
+                LIMIT %s;
+                """,
+                (ANSWER_PRELOAD_WINDOW_DAYS, limit)
+            )
+            rows = cur.fetchall()
+    finally:
+        release_connection(conn)
+
+    # Se insertan de la menos a la más pedida para que el LRU las conserve
+    for cache_key, answer, sources in reversed(rows):
+        _answer_memo.put(
+            cache_key,
+            {"answer": answer, "sources": sources},
+            ttl=ANSWER_PRELOAD_TTL,
+        )
+    return len(rows)
 
 # --------------------------------------------------
 # Deduplicación + reranking
@@ -133,6 +412,52 @@ def _rerank(results: List[Dict], top_k: int) -> List[Dict]:
     ranked.sort(key=lambda x: x["_score"], reverse=True)
     return ranked[:top_k]
 
+def _mmr_rerank(
+    results: List[Dict],
+    top_k: int,
+    lambda_: float = MMR_LAMBDA,
+    duplicate_threshold: float = MMR_DUPLICATE_THRESHOLD,
+) -> List[Dict]:
+    """Maximal marginal relevance sobre los embeddings de los candidatos.
+
+    Elige de forma voraz el candidato con mayor
+    lambda * similitud_query - (1 - lambda) * max_similitud_con_elegidos,
+    y descarta los casi duplicados de algo ya elegido, por lo que puede
+    devolver menos de `top_k` resultados.
+    """
+    if not results:
+        return []
+
+    emb = np.asarray([r["embedding"] for r in results], dtype=np.float32)
+    emb /= np.linalg.norm(emb, axis=1, keepdims=True) + 1e-12
+    relevance = np.fromiter(
+        (r["similarity"] for r in results), dtype=np.float32, count=len(results)
+    )
+    pairwise = emb @ emb.T
+
+    n = len(results)
+    redundancy = np.full(n, -np.inf, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    selected = []
+
+    while len(selected) < top_k and available.any():
+        if selected:
+            scores = lambda_ * relevance - (1 - lambda_) * redundancy
+        else:
+            scores = relevance.copy()
+        scores[~available] = -np.inf
+        idx = int(np.argmax(scores))
+
+        selected.append(idx)
+        available[idx] = False
+        redundancy = np.maximum(redundancy, pairwise[idx])
+        available &= redundancy < duplicate_threshold
+
+    return [
+        {**results[i], "_score": float(relevance[i])}
+        for i in selected
+    ]
+
 # --------------------------------------------------
 # Search (solo retrieval)
 # --------------------------------------------------
@@ -142,20 +467,52 @@ def search(
     module: str | None,
     language: str | None,
     top_k: int,
-    similarity_threshold: float
+    similarity_threshold: float,
+    rerank: str | None = None,
+    priority: int = INTERACTIVE
 ) -> List[Dict]:
 
-    query_vector = _embed(query_text)
-    conn = _get_connection()
+    model = get_active_model()
+    query_vector = _embed(query_text, model, priority)
+    return search_by_vector(
+        query_vector, model, domain, module, language,
+        top_k=top_k,
+        similarity_threshold=similarity_threshold,
+        rerank=rerank
+    )
 
-    SQL_LIMIT = max(top_k * 3, 10)
+def ann_candidates(
+    query_vector: Vector,
+    model: str,
+    domain: str,
+    module: str | None,
+    language: str | None,
+    limit: int,
+    similarity_threshold: float | None = None,
+    session_settings: Dict | None = None
+) -> List[Dict]:
+    """Candidatos tal como los devuelve el índice, sin dedupe ni rerank.
 
+    `session_settings` aplica parámetros de sesión de la lista
+    SEARCH_SESSION_SETTINGS solo durante esta consulta.
+    """
+    session_settings = session_settings or {}
+    unknown = set(session_settings) - SEARCH_SESSION_SETTINGS
+    if unknown:
+        raise ValueError(f"Parámetros de sesión no permitidos: {unknown}")
+
+    conn = get_connection()
     try:
         with conn.cursor() as cur:
+            for name, value in session_settings.items():
+                cur.execute("SELECT set_config(%s, %s, false);", (name, str(value)))
+
             sql = """
                 SELECT
+                    c.id,
                     c.content,
-                    1 - (e.embedding <=> %s) AS similarity
+                    1 - (e.embedding <=> %s) AS similarity,
+                    e.embedding
                 FROM embeddings e
                 JOIN chunks c ON c.id = e.chunk_id
                 JOIN documents d ON d.id = c.document_id
@@ -164,7 +521,7 @@ def search(
                     AND d.domain = %s
             """
 
-            params = [query_vector, EMBEDDING_MODEL, domain]
+            params = [query_vector, model, domain]
 
             if module:
                 sql += " AND d.module = %s"
@@ -174,34 +531,75 @@ def search(
                 sql += " AND d.language = %s"
                 params.append(language)
 
+            if similarity_threshold is not None:
+                sql += " AND (1 - (e.embedding <=> %s)) >= %s"
+                params.extend([query_vector, similarity_threshold])
+
             sql += """
-                AND (1 - (e.embedding <=> %s)) >= %s
                 ORDER BY e.embedding <=> %s
                 LIMIT %s;
             """
-
-            params.extend([
-                query_vector,
-                similarity_threshold,
-                query_vector,
-                SQL_LIMIT
-            ])
+            params.extend([query_vector, limit])
 
             cur.execute(sql, params)
             rows = cur.fetchall()
 
-        raw_results = [
-            {"content": c, "similarity": float(s)}
-            for c, s in rows
+        return [
+            {
+                "chunk_id": str(cid),
+                "content": c,
+                "similarity": float(s),
+                "embedding": emb,
+            }
+            for cid, c, s, emb in rows
         ]
 
-        deduped = _deduplicate(raw_results)
-        reranked = _rerank(deduped, top_k)
+    finally:
+        # Las conexiones vuelven al pool: no dejar parámetros cambiados
+        if session_settings and not conn.closed:
+            with conn.cursor() as cur:
+                for name in session_settings:
+                    cur.execute(f"RESET {name};")
+        release_connection(conn)
+
+def search_by_vector(
+    query_vector: Vector,
+    model: str,
+    domain: str,
+    module: str | None,
+    language: str | None,
+    top_k: int,
+    similarity_threshold: float,
+    rerank: str | None = None,
+    candidate_limit: int | None = None,
+    session_settings: Dict | None = None
+) -> List[Dict]:
+    """Búsqueda con un vector ya calculado (no llama a OpenAI)."""
+    load_env()
+    rerank = rerank or os.getenv("RERANK_STRATEGY", DEFAULT_RERANK)
+    if rerank not in ("mmr", "length"):
+        raise ValueError(f"Estrategia de rerank desconocida: {rerank}")
+
+    SQL_LIMIT = candidate_limit or max(top_k * 3, 10)
+
+    raw_results = ann_candidates(
+        query_vector, model, domain, module, language,
+        limit=SQL_LIMIT,
+        similarity_threshold=similarity_threshold,
+        session_settings=session_settings
+    )
 
-        return reranked
+    deduped = _deduplicate(raw_results)
+    if rerank == "mmr":
+        reranked = _mmr_rerank(deduped, top_k)
+    else:
+        reranked = _rerank(deduped, top_k)
 
-    finally:
-        conn.close()
+    # Los vectores solo se usan aquí; no viajan a la respuesta ni a la cache
+    return [
+        {k: v for k, v in r.items() if k != "embedding"}
+        for r in reranked
+    ]
 
 # --------------------------------------------------
 # Answering (RAG completo)
@@ -211,7 +609,9 @@ def answer_question(
     domain: str,
     module: str | None,
     language: str,
-    top_k: int = 5
+    top_k: int = 5,
+    priority: int = INTERACTIVE,
+    log_metrics: bool = True
 ) -> Dict:
 
     cache_key = _cache_key(question, domain, module, language)
@@ -220,6 +620,11 @@ def answer_question(
     cached = _get_cached_answer(cache_key)
     if cached:
         print("⚡ CACHE HIT")
+        # Los aciertos también cuentan: el warming mide frecuencia con esto
+        if log_metrics:
+            _log_metrics_async(
+                question, domain, module, language, "cache", cached["sources"]
+            )
         return cached
 
     print("🧠 CACHE MISS → RAG")
@@ -227,7 +632,8 @@ def answer_question(
     results = search(
         question, domain, module, language,
         top_k=top_k,
-        similarity_threshold=0.35
+        similarity_threshold=STRICT_THRESHOLD,
+        priority=priority
     )
     mode = "strict"
 
@@ -235,7 +641,8 @@ def answer_question(
         results = search(
             question, domain, module, language,
             top_k=top_k,
-            similarity_threshold=0.25
+            similarity_threshold=FALLBACK_THRESHOLD,
+            priority=priority
         )
         mode = "fallback"
 
@@ -273,13 +680,18 @@ Pregunta:
 {question}
 """
 
-    response = _client.chat.completions.create(
-        model=CHAT_MODEL,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.2,
+    response = get_scheduler().call(
+        lambda: _get_client().chat.completions.create(
+            model=CHAT_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            temperature=0.2,
+        ),
+        priority=priority,
+        tokens=estimate_tokens(system_prompt, user_prompt) + CHAT_MAX_OUTPUT_TOKENS,
+        kind="chat",
     )
 
     answer_text = response.choices[0].message.content.strip()
@@ -294,7 +706,9 @@ Pregunta:
         numbered
     )
 
-    _log_metrics(question, domain, module, language, mode, numbered)
+    # El warming no registra métricas para no sesgar futuras ejecuciones
+    if log_metrics:
+        _log_metrics_async(question, domain, module, language, mode, numbered)
 
     return {
         "answer": answer_text,
@@ -318,7 +732,7 @@ def _log_metrics(
         if results else 0.0
     )
 
-    conn = _get_connection()
+    conn = get_connection()
     try:
         with conn.cursor() as cur:
             cur.execute(
@@ -340,5 +754,32 @@ def _log_metrics(
                 )
             )
     finally:
-        conn.close()
+        release_connection(conn)
 
+_metrics_executor = ThreadPoolExecutor(
+    max_workers=METRICS_WORKERS, thread_name_prefix="metrics"
+)
+_metrics_slots = threading.BoundedSemaphore(METRICS_MAX_PENDING)
+
+def _log_metrics_safe(*args):
+    # Una métrica perdida nunca debe convertir una respuesta en un 500
+    try:
+        _log_metrics(*args)
+    except psycopg2.Error as e:
+        print(f"⚠️ Métrica no registrada: {e}")
+    finally:
+        _metrics_slots.release()
+
+def _log_metrics_async(*args):
+    if not _metrics_slots.acquire(blocking=False):
+        print("⚠️ Cola de métricas llena; se descarta la métrica")
+        return
+    try:
+        _metrics_executor.submit(_log_metrics_safe, *args)
+    except RuntimeError:
+        # Executor ya cerrado (apagado de la app)
+        _metrics_slots.release()
+
+def flush_metrics():
+    """Espera a que se escriban las métricas pendientes; llamar al apagar."""
+    _metrics_executor.shutdown(wait=True)
@@ -0,0 +1,187 @@
+import os
+import random
+import threading
+import time
+import psycopg2
+
+from services.db import get_connection, release_connection, pool_size
+
+# --------------------------------------------------
+# Configuración
+# --------------------------------------------------
+# Fracción de bloques ya en shared_buffers a partir de la cual no se
+# vuelve a precalentar un índice
+PREWARM_SKIP_CACHED = 0.9
+
+# Backoff (segundos) mientras Postgres no esté disponible
+POOL_RETRY_BASE = 1.0
+POOL_RETRY_MAX = 60.0
+
+# --------------------------------------------------
+# Estado de readiness
+# --------------------------------------------------
+_ready = threading.Event()
+_status = {"stage": "pending", "error": None, "duration_ms": None}
+
+def is_ready() -> bool:
+    return _ready.is_set()
+
+def status() -> dict:
+    return {"ready": is_ready(), **_status}
+
+# --------------------------------------------------
+# Etapas
+# --------------------------------------------------
+def _preopen_connections() -> int:
+    # Abrir y devolver min_size conexiones registra también los tipos de pgvector
+    min_size, _ = pool_size()
+    conns = []
+    try:
+        for _ in range(min_size):
+            conns.append(get_connection())
+    finally:
+        for conn in conns:
+            release_connection(conn)
+    return len(conns)
+
+def _prewarm_vector_indexes() -> int:
+    """Carga en shared_buffers los índices vectoriales de embeddings.
+
+    No ejecuta DDL: requiere que pg_prewarm ya esté instalado. Si además
+    existe pg_buffercache, se saltan los índices que ya están en memoria
+    (p. ej. porque otra réplica los precalentó).
+    """
+    conn = get_connection()
+    warmed = 0
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT extname FROM pg_extension
+                WHERE extname IN ('pg_prewarm', 'pg_buffercache');
+                """
+            )
+            extensions = {r[0] for r in cur.fetchall()}
+            if "pg_prewarm" not in extensions:
+                print("⚠️ pg_prewarm no instalado; se omite el prewarm")
+                return 0
+
+            cur.execute(
+                """
+                SELECT i.indexrelid::regclass::text,
+                       pg_relation_size(i.indexrelid)
+                           / current_setting('block_size')::int AS blocks
+                FROM pg_index i
+                JOIN pg_class ic ON ic.oid = i.indexrelid
+                JOIN pg_am am ON am.oid = ic.relam
+                WHERE i.indrelid = 'embeddings'::regclass
+                  AND am.amname IN ('hnsw', 'ivfflat');
+                """
+            )
+            indexes = cur.fetchall()
+
+            for rel, blocks in indexes:
+                if "pg_buffercache" in extensions and blocks:
+                    cur.execute(
+                        """
+                        SELECT count(*)
+                        FROM pg_buffercache
+                        WHERE relfilenode = pg_relation_filenode(%s::regclass)
+                          AND reldatabase = (
+                              SELECT oid FROM pg_database
+                              WHERE datname = current_database()
+                          );
+                        """,
+                        (rel,)
+                    )
+                    cached = cur.fetchone()[0]
+                    if cached >= PREWARM_SKIP_CACHED * blocks:
+                        print(f"⏭️ {rel} ya en memoria ({cached}/{blocks} bloques)")
+                        continue
+
+                cur.execute("SELECT pg_prewarm(%s::regclass);", (rel,))
+                print(f"🔥 prewarm {rel}: {cur.fetchone()[0]} bloques")
+                warmed += 1
+    finally:
+        release_connection(conn)
+    return warmed
+
+def _preload_caches() -> int:
+    from services.retrieval_service import preload_answer_cache
+    return preload_answer_cache()
+
+def _preopen_with_retry() -> int:
+    # Si Postgres no responde al arrancar se reintenta indefinidamente:
+    # /ready sigue en 503 hasta que la base de datos vuelva
+    attempt = 0
+    while True:
+        try:
+            opened = _preopen_connections()
+            _status["error"] = None
+            return opened
+        except Exception as e:
+            delay = min(POOL_RETRY_MAX, POOL_RETRY_BASE * 2 ** attempt)
+            delay *= random.uniform(0.5, 1.0)
+            attempt += 1
+            _status["stage"] = "pool_retry"
+            _status["error"] = str(e)
+            print(f"⚠️ Pool no disponible (intento {attempt}), reintento en {delay:.1f}s: {e}")
+            time.sleep(delay)
+
+# --------------------------------------------------
+# Warm-up completo
+# --------------------------------------------------
+def run_warmup():
+    """Ejecuta el warm-up y marca la instancia como lista al terminar.
+
+    Un fallo en una etapa opcional no bloquea el readiness; el pool se
+    reintenta con backoff hasta que Postgres responda, porque sin él la
+    instancia no podría atender /ask.
+    """
+    start = time.perf_counter()
+    try:
+        _status["stage"] = "pool"
+        opened = _preopen_with_retry()
+        print(f"🔌 Pool precalentado: {opened} conexiones")
+
+        # Desactivado por defecto: todas las réplicas comparten Postgres y un
+        # scale-out no debe releer el índice mientras sube la carga
+        if os.getenv("WARMUP_PREWARM", "false").lower() == "true":
+            _status["stage"] = "prewarm"
+            try:
+                _prewarm_vector_indexes()
+            except psycopg2.Error as e:
+                print(f"⚠️ Prewarm incompleto: {e}")
+
+        if os.getenv("WARMUP_PRELOAD_CACHE", "true").lower() == "true":
+            _status["stage"] = "cache"
+            try:
+                loaded = _preload_caches()
+                print(f"⚡ Cache precargada: {loaded} respuestas")
+            except psycopg2.Error as e:
+                print(f"⚠️ Precarga de cache fallida: {e}")
+
+        # Opcional: carga los vectores de las preguntas frecuentes ya
+        # respondidas en answer_cache. No genera respuestas; solo embebe las
+        # que no estén en query_embeddings y con tope de tiempo
+        if os.getenv("WARMUP_QUERY_EMBEDDINGS", "false").lower() == "true":
+            _status["stage"] = "embeddings"
+            try:
+                from services.cache_warming import warm_replica
+                warm_replica(float(os.getenv("WARMUP_EMBEDDINGS_SECONDS", "20")))
+            except Exception as e:
+                print(f"⚠️ Warming de embeddings fallido: {e}")
+
+        _status["stage"] = "done"
+        _ready.set()
+    except Exception as e:
+        _status["stage"] = "failed"
+        _status["error"] = str(e)
+        print(f"❌ Warm-up fallido: {e}")
+    finally:
+        _status["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+def start_warmup() -> threading.Thread:
+    thread = threading.Thread(target=run_warmup, name="warmup", daemon=True)
+    thread.start()
+    return thread
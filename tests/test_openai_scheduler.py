@@ -0,0 +1,179 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+import httpx
+import psycopg2
+from openai import RateLimitError
+
+from services import openai_scheduler
+from services.openai_scheduler import OpenAIScheduler, INTERACTIVE, BATCH
+
+
+def _rate_limit_error():
+    request = httpx.Request("POST", "https://api.openai.com/v1/embeddings")
+    return RateLimitError(
+        "rate limited",
+        response=httpx.Response(429, request=request),
+        body=None,
+    )
+
+def _wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("condición no alcanzada a tiempo")
+        time.sleep(0.005)
+
+
+class FakeBudget:
+    def __init__(self, waits=None, error=None):
+        self.waits = list(waits or [])
+        self.error = error
+        self.calls = []
+
+    def take(self, tokens, priority):
+        self.calls.append(priority)
+        if self.error:
+            raise self.error
+        return self.waits.pop(0) if self.waits else 0.0
+
+    def report_throttled(self):
+        pass
+
+
+class AdaptiveConcurrencyTest(unittest.TestCase):
+    def test_rate_limit_halves_limit_and_blocks_increase(self):
+        sched = OpenAIScheduler(max_concurrency=8, max_attempts=1)
+
+        def fail():
+            raise _rate_limit_error()
+
+        with self.assertRaises(RateLimitError):
+            sched.call(fail)
+        self.assertEqual(sched.concurrency_limit, 4)
+
+        # Durante el cooldown un éxito no vuelve a subir el límite
+        sched.call(lambda: "ok")
+        self.assertEqual(sched._limit, 4.0)
+
+    def test_success_increases_additively(self):
+        sched = OpenAIScheduler(max_concurrency=8)
+        sched._limit = 4.0
+
+        self.assertEqual(sched.call(lambda: "ok"), "ok")
+        self.assertAlmostEqual(sched._limit, 4.25)
+
+    def test_latency_spike_decreases_limit(self):
+        sched = OpenAIScheduler(max_concurrency=8)
+        sched._latency_avg["chat"] = 0.001
+
+        sched.call(lambda: time.sleep(0.05), kind="chat")
+        self.assertAlmostEqual(sched._limit, 7.2)
+
+    def test_retries_after_rate_limit(self):
+        sched = OpenAIScheduler(max_concurrency=8, max_attempts=3)
+        attempts = []
+
+        def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise _rate_limit_error()
+            return "ok"
+
+        with mock.patch("tenacity.nap.time.sleep"):
+            self.assertEqual(sched.call(flaky), "ok")
+        self.assertEqual(len(attempts), 2)
+
+
+class PriorityTest(unittest.TestCase):
+    def test_interactive_served_before_queued_batch(self):
+        sched = OpenAIScheduler(max_concurrency=1, min_concurrency=1)
+        release = threading.Event()
+        order = []
+
+        holder = threading.Thread(
+            target=sched.call, args=(release.wait,), kwargs={"priority": BATCH}
+        )
+        holder.start()
+        _wait_until(lambda: sched._in_flight == 1)
+
+        batch = threading.Thread(
+            target=sched.call,
+            args=(lambda: order.append("batch"),),
+            kwargs={"priority": BATCH},
+        )
+        batch.start()
+        _wait_until(lambda: len(sched._waiters) == 1)
+
+        interactive = threading.Thread(
+            target=sched.call,
+            args=(lambda: order.append("interactive"),),
+            kwargs={"priority": INTERACTIVE},
+        )
+        interactive.start()
+        _wait_until(lambda: len(sched._waiters) == 2)
+
+        release.set()
+        for t in (holder, batch, interactive):
+            t.join(timeout=2)
+        self.assertEqual(order, ["interactive", "batch"])
+
+    def test_batch_leaves_room_for_interactive(self):
+        sched = OpenAIScheduler(max_concurrency=4)
+        release = threading.Event()
+
+        # BATCH_SHARE = 0.75: tres huecos para BATCH, el cuarto queda libre
+        holders = [
+            threading.Thread(
+                target=sched.call, args=(release.wait,), kwargs={"priority": BATCH}
+            )
+            for _ in range(3)
+        ]
+        for t in holders:
+            t.start()
+        _wait_until(lambda: sched._in_flight == 3)
+
+        blocked = threading.Thread(
+            target=sched.call, args=(lambda: None,), kwargs={"priority": BATCH}
+        )
+        blocked.start()
+        _wait_until(lambda: len(sched._waiters) == 1)
+
+        self.assertEqual(sched.call(lambda: "ok", priority=INTERACTIVE), "ok")
+        self.assertTrue(blocked.is_alive())
+
+        release.set()
+        for t in holders + [blocked]:
+            t.join(timeout=2)
+        self.assertFalse(blocked.is_alive())
+
+
+class SharedBudgetTest(unittest.TestCase):
+    def test_interactive_wait_is_capped(self):
+        budget = FakeBudget(waits=[100.0] * 1000)
+        sched = OpenAIScheduler(shared_budget=budget)
+
+        with mock.patch.object(openai_scheduler, "MAX_INTERACTIVE_SHARED_WAIT", 0.05), \
+             mock.patch.object(openai_scheduler, "MAX_SHARED_WAIT", 0.01):
+            start = time.monotonic()
+            self.assertEqual(sched.call(lambda: "ok", priority=INTERACTIVE), "ok")
+        self.assertLess(time.monotonic() - start, 1.0)
+
+    def test_batch_waits_until_budget_grants(self):
+        budget = FakeBudget(waits=[0.01, 0.01, 0.0])
+        sched = OpenAIScheduler(shared_budget=budget)
+
+        self.assertEqual(sched.call(lambda: "ok", priority=BATCH), "ok")
+        self.assertEqual(budget.calls, [BATCH, BATCH, BATCH])
+
+    def test_database_error_falls_back_to_local_bucket(self):
+        budget = FakeBudget(error=psycopg2.OperationalError("down"))
+        sched = OpenAIScheduler(shared_budget=budget)
+
+        self.assertEqual(sched.call(lambda: "ok"), "ok")
+
+
+if __name__ == "__main__":
+    unittest.main()
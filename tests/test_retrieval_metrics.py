@@ -0,0 +1,51 @@
+import threading
+import unittest
+from unittest import mock
+
+import psycopg2
+
+from services import retrieval_service
+
+
+CACHED = {
+    "answer": "respuesta",
+    "sources": [{"id": 1, "content": "texto", "similarity": 0.9}],
+    "cached": True,
+}
+
+
+class CacheHitMetricsTest(unittest.TestCase):
+    def test_cache_hit_survives_metrics_failure(self):
+        attempted = threading.Event()
+
+        def broken_log(*args):
+            attempted.set()
+            raise psycopg2.OperationalError("sin conexión")
+
+        with mock.patch.object(retrieval_service, "_get_cached_answer", return_value=CACHED), \
+             mock.patch.object(retrieval_service, "_log_metrics", side_effect=broken_log):
+            result = retrieval_service.answer_question("¿pregunta?", "odoo", None, "es")
+            self.assertTrue(attempted.wait(2))
+
+        self.assertEqual(result, CACHED)
+
+    def test_cache_hit_does_not_wait_for_metrics(self):
+        release = threading.Event()
+        logged = threading.Event()
+
+        def slow_log(*args):
+            release.wait(2)
+            logged.set()
+
+        with mock.patch.object(retrieval_service, "_get_cached_answer", return_value=CACHED), \
+             mock.patch.object(retrieval_service, "_log_metrics", side_effect=slow_log):
+            result = retrieval_service.answer_question("¿pregunta?", "odoo", None, "es")
+            self.assertFalse(logged.is_set())
+            release.set()
+            self.assertTrue(logged.wait(2))
+
+        self.assertEqual(result, CACHED)
+
+
+if __name__ == "__main__":
+    unittest.main()